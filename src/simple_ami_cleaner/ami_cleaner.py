@@ -2,14 +2,33 @@ import sys
 
 import logging
 import fnmatch
-from datetime import datetime
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .report import NULL_REPORT_WRITER
 
 _logger = logging.getLogger(__name__)
 
+# The number of snapshot ids resolved per describe_snapshots call when estimating savings
+DESCRIBE_SNAPSHOTS_BATCH_SIZE = 200
+
+# Descriptions EC2 assigns to the snapshots it creates on behalf of CreateImage and CopyImage, only snapshots
+# matching these are ever considered orphans (manually created volume backups are left alone)
+AMI_SNAPSHOT_DESCRIPTION_PATTERN = re.compile(
+    r"^(Created by CreateImage\(.*\) for|Copied for DestinationAmi) (ami-[0-9a-f]+)"
+)
+
+
+def record_api_call(report_writer, operation, start, **fields):
+    report_writer.record("api_call", operation=operation, duration_seconds=time.perf_counter() - start, **fields)
 
-def fetch_images(ec2_client, name_pattern):
+
+def fetch_images(ec2_client, name_pattern, report_writer=NULL_REPORT_WRITER):
+    start = time.perf_counter()
     images_response = ec2_client.describe_images(
         Owners=["self"],
         Filters=[
@@ -23,6 +42,7 @@ def fetch_images(ec2_client, name_pattern):
     )
 
     available_images = images_response.get("Images")
+    record_api_call(report_writer, "describe_images", start, item_count=len(available_images))
 
     return available_images
 
@@ -103,18 +123,93 @@ def fetch_image_ids_in_use_by_launch_templates(ec2_client):
     return images
 
 
+def fetch_image_ids_in_use_by_all_launch_template_versions(ec2_client, launch_template_state=None, rescan_days=7):
+    # launch template versions can't be modified, so only versions newer than the latest recorded in the state need
+    # to be fetched, the state is updated in place with the versions fetched and templates that no longer exist
+    # dropped. Versions can be deleted though, so every rescan_days all versions are fetched again to forget the AMIs
+    # of deleted versions
+    if launch_template_state is None:
+        launch_template_state = {}
+
+    present = datetime.now(timezone.utc)
+    last_full_scan = launch_template_state.get("LastFullScan")
+    if last_full_scan is None or (present - datetime.fromisoformat(last_full_scan)).days >= rescan_days:
+        _logger.info(f"Fetching all launch template versions, the last full scan was at {last_full_scan}...")
+        known_launch_templates = {}
+        launch_template_state["LastFullScan"] = present.isoformat()
+    else:
+        known_launch_templates = launch_template_state.get("LaunchTemplates", {})
+
+    paginator = ec2_client.get_paginator("describe_launch_templates")
+    page_iterator = paginator.paginate()
+
+    launch_templates = {}
+    fetched_count = 0
+    for page in page_iterator:
+        for launch_template in page["LaunchTemplates"]:
+            launch_template_id = launch_template["LaunchTemplateId"]
+            known_launch_template = known_launch_templates.get(
+                launch_template_id, {"LatestVersionNumber": 0, "ImageIds": {}}
+            )
+
+            if launch_template["LatestVersionNumber"] > known_launch_template["LatestVersionNumber"]:
+                versions_paginator = ec2_client.get_paginator("describe_launch_template_versions")
+                versions_page_iterator = versions_paginator.paginate(
+                    LaunchTemplateId=launch_template_id,
+                    MinVersion=str(known_launch_template["LatestVersionNumber"] + 1),
+                )
+                for versions_page in versions_page_iterator:
+                    for launch_template_version in versions_page["LaunchTemplateVersions"]:
+                        fetched_count = fetched_count + 1
+                        if "ImageId" in launch_template_version.get("LaunchTemplateData", {}):
+                            known_launch_template["ImageIds"][str(launch_template_version["VersionNumber"])] = \
+                                launch_template_version["LaunchTemplateData"]["ImageId"]
+                known_launch_template["LatestVersionNumber"] = launch_template["LatestVersionNumber"]
+
+            launch_templates[launch_template_id] = known_launch_template
+
+    launch_template_state["LaunchTemplates"] = launch_templates
+
+    images = set()
+    for launch_template_id, launch_template in launch_templates.items():
+        for version_number, image_id in launch_template["ImageIds"].items():
+            _logger.info(
+                f"Found AMI {image_id} currently in use by launch template ({launch_template_id}:{version_number})")
+            images.add(image_id)
+
+    _logger.info(f"Found {len(images)} AMIs currently in use by all versions of {len(launch_templates)} launch "
+                 f"templates, {fetched_count} new versions were fetched...")
+
+    return images
+
+
 def check_name_match(image_name, name_pattern):
     return fnmatch.fnmatch(image_name, name_pattern)
 
 
-def fetch_image_ids_in_use(ec2_client, name_pattern):
+def fetch_image_ids_in_use(
+        ec2_client,
+        name_pattern,
+        all_launch_template_versions=False,
+        launch_template_state=None,
+        launch_template_rescan_days=7,
+):
     all_image_ids = set()
     all_image_ids.update(
         fetch_image_ids_in_use_by_instances(ec2_client=ec2_client)
     )
-    all_image_ids.update(
-        fetch_image_ids_in_use_by_launch_templates(ec2_client=ec2_client)
-    )
+    if all_launch_template_versions:
+        all_image_ids.update(
+            fetch_image_ids_in_use_by_all_launch_template_versions(
+                ec2_client=ec2_client,
+                launch_template_state=launch_template_state,
+                rescan_days=launch_template_rescan_days,
+            )
+        )
+    else:
+        all_image_ids.update(
+            fetch_image_ids_in_use_by_launch_templates(ec2_client=ec2_client)
+        )
 
     matching_image_ids = set()
     for image_id in all_image_ids:
@@ -132,34 +227,54 @@ def fetch_image_ids_in_use(ec2_client, name_pattern):
     return matching_image_ids
 
 
-def delete_snapshot(ec2_client, snapshot_id, dry_run):
+def delete_snapshot(ec2_client, snapshot_id, dry_run, report_writer=NULL_REPORT_WRITER):
     _logger.info(f"Deleting snapshot {snapshot_id}")
 
     if dry_run:
         _logger.info(f"Skipping deleting snapshot in dry-run mode")
+        report_writer.record("would_delete", resource_type="snapshot", resource_id=snapshot_id, dry_run=True)
         return
 
+    start = time.perf_counter()
     try:
         ec2_client.delete_snapshot(
             SnapshotId=snapshot_id
         )
+        report_writer.record(
+            "deleted", resource_type="snapshot", resource_id=snapshot_id, dry_run=False,
+            duration_seconds=time.perf_counter() - start,
+        )
         _logger.info(f"Done deleting snapshot")
-    except ClientError:
+    except (ClientError, BotoCoreError) as e:
+        report_writer.record(
+            "failed", resource_type="snapshot", resource_id=snapshot_id, dry_run=False,
+            duration_seconds=time.perf_counter() - start, error=str(e),
+        )
         _logger.critical(msg=f"Error raised while attempting to delete snapshot {snapshot_id}", exc_info=True)
         raise Exception(f"Failed deleting snapshot {snapshot_id}")
 
 
-def deregister_image(ec2_client, image, dry_run):
+def deregister_image(ec2_client, image, dry_run, report_writer=NULL_REPORT_WRITER):
     _logger.info(f"Deregistering AMI: {image_to_string(image)}")
 
     if dry_run:
         _logger.info(f"Skipping deregistering AMI in dry-run mode")
+        report_writer.record("would_delete", resource_type="image", resource_id=image["ImageId"], dry_run=True)
         return
 
+    start = time.perf_counter()
     try:
         ec2_client.deregister_image(ImageId=image["ImageId"])
+        report_writer.record(
+            "deleted", resource_type="image", resource_id=image["ImageId"], dry_run=False,
+            duration_seconds=time.perf_counter() - start,
+        )
         _logger.info(f"Done deregistering AMI")
-    except ClientError:
+    except (ClientError, BotoCoreError) as e:
+        report_writer.record(
+            "failed", resource_type="image", resource_id=image["ImageId"], dry_run=False,
+            duration_seconds=time.perf_counter() - start, error=str(e),
+        )
         _logger.critical(msg=f"Error raised while attempting to deregister AMI {image['ImageId']}", exc_info=True)
         raise Exception(f"Failed deleting AMI {image['ImageId']}")
 
@@ -252,34 +367,119 @@ def filter_images(images, keep=-1, min_age_days=-1, excluded_image_ids=None):
     return images
 
 
-def deregister_images_and_snapshots(ec2_client, images, dry_run):
+def image_snapshot_ids(image):
+    snapshot_ids = []
+    for block_device in image.get("BlockDeviceMappings", []):
+        if "Ebs" in block_device and "SnapshotId" in block_device["Ebs"]:
+            snapshot_ids.append(block_device["Ebs"]["SnapshotId"])
+
+    return snapshot_ids
+
+
+def deregister_images_and_snapshots(ec2_client, images, dry_run, report_writer=NULL_REPORT_WRITER):
     images = images or []
     for image in images:
-        deregister_image(ec2_client=ec2_client, image=image, dry_run=dry_run)
+        deregister_image(ec2_client=ec2_client, image=image, dry_run=dry_run, report_writer=report_writer)
 
-        for block_device in image["BlockDeviceMappings"]:
-            if "Ebs" in block_device and "SnapshotId" in block_device["Ebs"]:
-                snapshot_id = block_device["Ebs"]["SnapshotId"]
-                delete_snapshot(ec2_client=ec2_client, snapshot_id=snapshot_id, dry_run=dry_run)
+        for snapshot_id in image_snapshot_ids(image):
+            delete_snapshot(
+                ec2_client=ec2_client, snapshot_id=snapshot_id, dry_run=dry_run, report_writer=report_writer
+            )
 
 
-def clean_images(
+def fetch_candidate_images(
         ec2_client,
         name_pattern,
         min_age_days=90, keep=3,
         excluded_image_ids=None,
-        force=False,
-        dry_run=True,
+        report_writer=NULL_REPORT_WRITER,
 ):
     _logger.info(f"Fetching AMIs matching name '{name_pattern}' with a min age of {min_age_days} days...")
 
-    images = fetch_images(ec2_client=ec2_client, name_pattern=name_pattern)
+    images = fetch_images(ec2_client=ec2_client, name_pattern=name_pattern, report_writer=report_writer)
 
     _logger.info(
         f"Found {len(images)} AMIs matching '{name_pattern}'..."
     )
 
-    images = filter_images(images=images, keep=keep, min_age_days=min_age_days, excluded_image_ids=excluded_image_ids)
+    return filter_images(images=images, keep=keep, min_age_days=min_age_days, excluded_image_ids=excluded_image_ids)
+
+
+def fetch_snapshot_volume_sizes(
+        ec2_client, snapshot_ids, batch_size=DESCRIBE_SNAPSHOTS_BATCH_SIZE, report_writer=NULL_REPORT_WRITER
+):
+    snapshot_ids = sorted(set(snapshot_ids))
+
+    volume_sizes = {}
+    for start in range(0, len(snapshot_ids), batch_size):
+        # unlike SnapshotIds, a snapshot-id filter leaves out missing snapshots rather than failing the whole batch
+        start_time = time.perf_counter()
+        snapshots_response = ec2_client.describe_snapshots(
+            OwnerIds=["self"],
+            Filters=[
+                {
+                    "Name": "snapshot-id",
+                    "Values": snapshot_ids[start:start + batch_size],
+                },
+            ],
+        )
+        record_api_call(
+            report_writer, "describe_snapshots", start_time, item_count=len(snapshots_response["Snapshots"])
+        )
+        for snapshot in snapshots_response["Snapshots"]:
+            volume_sizes[snapshot["SnapshotId"]] = snapshot["VolumeSize"]
+
+    missing_snapshot_ids = [snapshot_id for snapshot_id in snapshot_ids if snapshot_id not in volume_sizes]
+    if missing_snapshot_ids:
+        _logger.warning(f"Unable to find snapshots {missing_snapshot_ids}, they may have already been deleted")
+
+    return volume_sizes
+
+
+def estimate_savings(ec2_client, images, name_pattern, region, report_writer=NULL_REPORT_WRITER):
+    snapshot_ids = set()
+    for image in images:
+        snapshot_ids.update(image_snapshot_ids(image))
+
+    volume_sizes = fetch_snapshot_volume_sizes(
+        ec2_client=ec2_client, snapshot_ids=snapshot_ids, report_writer=report_writer
+    )
+
+    # snapshots are stored incrementally so the full volume size is an upper bound of what will be saved
+    estimated_gb_month_savings = sum(volume_sizes.values())
+
+    _logger.info(
+        f"Removing {len(images)} AMIs matching '{name_pattern}' in {region} would free {len(volume_sizes)} "
+        f"snapshots, saving up to {estimated_gb_month_savings} GB-month..."
+    )
+
+    return {
+        "name_pattern": name_pattern,
+        "region": region,
+        "image_count": len(images),
+        "snapshot_count": len(volume_sizes),
+        "missing_snapshot_count": len(snapshot_ids) - len(volume_sizes),
+        "estimated_gb_month_savings": estimated_gb_month_savings,
+    }
+
+
+def clean_images(
+        ec2_client,
+        name_pattern,
+        min_age_days=90, keep=3,
+        excluded_image_ids=None,
+        force=False,
+        dry_run=True,
+        report_writer=NULL_REPORT_WRITER,
+):
+    images = fetch_candidate_images(
+        ec2_client=ec2_client,
+        name_pattern=name_pattern,
+        keep=keep,
+        min_age_days=min_age_days,
+        excluded_image_ids=excluded_image_ids,
+        report_writer=report_writer,
+    )
 
     if len(images) == 0:
         _logger.info(f"No AMIs found for removal...")
@@ -288,11 +488,167 @@ def clean_images(
     _logger.info(f"The following AMIs are going to be removed:")
     for image in images:
         _logger.info(image_to_string(image=image))
+        report_writer.record(
+            "candidate", resource_type="image", resource_id=image["ImageId"], name=image["Name"],
+            creation_date=image["CreationDate"], snapshot_ids=image_snapshot_ids(image),
+        )
 
     if not force:
         confirmation_input = input(f"Proceed with the removal of {len(images)} AMIs (Y/N)? ")
         if "Y" == confirmation_input or "y" == confirmation_input:
-            deregister_images_and_snapshots(ec2_client=ec2_client, images=images, dry_run=dry_run)
+            deregister_images_and_snapshots(
+                ec2_client=ec2_client, images=images, dry_run=dry_run, report_writer=report_writer
+            )
     else:
         _logger.info(f"Proceeding with forced removal of {len(images)} AMIs...")
-        deregister_images_and_snapshots(ec2_client=ec2_client, images=images, dry_run=dry_run)
+        deregister_images_and_snapshots(
+            ec2_client=ec2_client, images=images, dry_run=dry_run, report_writer=report_writer
+        )
+
+
+def fetch_snapshots(ec2_client, report_writer=NULL_REPORT_WRITER):
+    paginator = ec2_client.get_paginator("describe_snapshots")
+    page_iterator = paginator.paginate(OwnerIds=["self"])
+
+    snapshots = []
+    start = time.perf_counter()
+    for page in page_iterator:
+        record_api_call(report_writer, "describe_snapshots", start, item_count=len(page["Snapshots"]))
+        snapshots.extend(page["Snapshots"])
+        start = time.perf_counter()
+
+    _logger.info(f"Found {len(snapshots)} snapshots owned by the current account...")
+
+    return snapshots
+
+
+def fetch_snapshot_ids_in_use_by_images(ec2_client, report_writer=NULL_REPORT_WRITER):
+    paginator = ec2_client.get_paginator("describe_images")
+    page_iterator = paginator.paginate(Owners=["self"], IncludeDeprecated=True, IncludeDisabled=True)
+
+    image_count = 0
+    snapshot_ids = set()
+    start = time.perf_counter()
+    for page in page_iterator:
+        record_api_call(report_writer, "describe_images", start, item_count=len(page["Images"]))
+        for image in page["Images"]:
+            image_count = image_count + 1
+            snapshot_ids.update(image_snapshot_ids(image))
+        start = time.perf_counter()
+
+    _logger.info(f"Found {len(snapshot_ids)} snapshots currently in use by {image_count} AMIs...")
+
+    return snapshot_ids
+
+
+def snapshot_to_string(snapshot):
+    return f"SnapshotId: {snapshot['SnapshotId']}, VolumeSize: {snapshot.get('VolumeSize')}, " \
+           f"StartTime: {snapshot['StartTime']}, Description: {snapshot.get('Description', '')}"
+
+
+def filter_orphaned_snapshots(snapshots, snapshot_ids_in_use):
+    orphaned_snapshots = []
+    for snapshot in snapshots:
+        if snapshot["SnapshotId"] in snapshot_ids_in_use:
+            continue
+        if snapshot.get("State", "completed") != "completed":
+            _logger.debug(f"Snapshot is not completed, filtering: {snapshot['SnapshotId']}")
+            continue
+        if not AMI_SNAPSHOT_DESCRIPTION_PATTERN.match(snapshot.get("Description", "")):
+            _logger.debug(f"Snapshot was not created for an AMI, filtering: {snapshot['SnapshotId']}")
+            continue
+        orphaned_snapshots.append(snapshot)
+
+    return orphaned_snapshots
+
+
+def filter_snapshots_by_age(snapshots, min_age_days=-1):
+    filtered_snapshots = []
+    filtered_count = 0
+    for snapshot in snapshots:
+        if min_age_days > 0:
+            present = datetime.now(timezone.utc)
+            delta = present - snapshot["StartTime"]
+            if delta.days > min_age_days:
+                filtered_snapshots.append(snapshot)
+            else:
+                _logger.info(f"Snapshot does not meet age threshold, filtering: {snapshot['SnapshotId']}")
+                filtered_count = filtered_count + 1
+        else:
+            filtered_snapshots.append(snapshot)
+
+    return filtered_snapshots, filtered_count
+
+
+def delete_snapshots(ec2_client, snapshots, dry_run, max_workers=4, report_writer=NULL_REPORT_WRITER):
+    snapshots = snapshots or []
+    failed_snapshot_ids = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                delete_snapshot, ec2_client=ec2_client, snapshot_id=snapshot["SnapshotId"], dry_run=dry_run,
+                report_writer=report_writer,
+            ): snapshot["SnapshotId"]
+            for snapshot in snapshots
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed_snapshot_ids.append(futures[future])
+
+    if failed_snapshot_ids:
+        _logger.error(f"Failed deleting {len(failed_snapshot_ids)} snapshots: {failed_snapshot_ids}")
+
+    return failed_snapshot_ids
+
+
+def sweep_snapshots(
+        ec2_client,
+        min_age_days=90,
+        force=False,
+        dry_run=True,
+        max_workers=4,
+        report_writer=NULL_REPORT_WRITER,
+):
+    _logger.info(f"Sweeping orphaned AMI snapshots with a min age of {min_age_days} days...")
+
+    # list snapshots before AMIs, a snapshot of an AMI created between the two listings is then always referenced by
+    # the later AMI listing rather than looking orphaned
+    snapshots = fetch_snapshots(ec2_client=ec2_client, report_writer=report_writer)
+    snapshot_ids_in_use = fetch_snapshot_ids_in_use_by_images(ec2_client=ec2_client, report_writer=report_writer)
+
+    snapshots = filter_orphaned_snapshots(snapshots=snapshots, snapshot_ids_in_use=snapshot_ids_in_use)
+    snapshots, filtered_by_age_count = filter_snapshots_by_age(snapshots=snapshots, min_age_days=min_age_days)
+
+    _logger.info(
+        f"{len(snapshots)} orphaned snapshots remain after filtering, {filtered_by_age_count} were excluded "
+        f"because of age..."
+    )
+
+    if len(snapshots) == 0:
+        _logger.info(f"No orphaned snapshots found for removal...")
+        sys.exit(0)
+
+    _logger.info(f"The following snapshots are going to be removed:")
+    for snapshot in snapshots:
+        _logger.info(snapshot_to_string(snapshot=snapshot))
+        report_writer.record(
+            "candidate", resource_type="snapshot", resource_id=snapshot["SnapshotId"],
+            volume_size=snapshot.get("VolumeSize"), start_time=snapshot["StartTime"].isoformat(),
+            description=snapshot.get("Description", ""),
+        )
+
+    if not force:
+        confirmation_input = input(f"Proceed with the removal of {len(snapshots)} snapshots (Y/N)? ")
+        if "Y" == confirmation_input or "y" == confirmation_input:
+            return delete_snapshots(
+                ec2_client=ec2_client, snapshots=snapshots, dry_run=dry_run, max_workers=max_workers,
+                report_writer=report_writer,
+            )
+    else:
+        _logger.info(f"Proceeding with forced removal of {len(snapshots)} snapshots...")
+        return delete_snapshots(
+            ec2_client=ec2_client, snapshots=snapshots, dry_run=dry_run, max_workers=max_workers,
+            report_writer=report_writer,
+        )
@@ -0,0 +1,102 @@
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+_logger = logging.getLogger(__name__)
+
+_CLOSE = object()
+
+
+class NullReportWriter:
+    """Discards every record, used when no report was requested"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def record(self, event, **fields):
+        pass
+
+
+NULL_REPORT_WRITER = NullReportWriter()
+
+
+class ReportWriter:
+    """Streams JSON lines report records to a file from a background thread
+
+    Records are queued without blocking the caller and written in batches, so reporting never holds up the
+    threads deleting AMIs and snapshots. A batch is written once it holds batch_size records or its first record
+    has waited flush_interval seconds, whichever comes first.
+
+    Args:
+      path (str): the file records are appended to
+      batch_size (int): the max number of records written per batch
+      flush_interval (float): the max number of seconds a record waits before being written
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._file = open(self.path, "a")
+        self._thread = threading.Thread(target=self._run, name="report-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is None:
+            return
+
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    def record(self, event, **fields):
+        self._queue.put({"timestamp": datetime.now(timezone.utc).isoformat(), "event": event, **fields})
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch = []
+            record = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if record is _CLOSE:
+                    closed = True
+                    break
+                batch.append(record)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self._file.write("".join(json.dumps(record, default=str) + "\n" for record in batch))
+            self._file.flush()
+        except OSError:
+            _logger.critical(msg=f"Error raised while attempting to write {len(batch)} records to report "
+                                 f"{self.path}", exc_info=True)
@@ -1,26 +1,40 @@
 import argparse
+import csv
+import json
 import logging
 import sys
 import os
+import threading
+from datetime import datetime
 
 import boto3
 from botocore.config import Config
 
 from simple_ami_cleaner import __version__
-from .ami_cleaner import clean_images, fetch_image_ids_in_use
+from .ami_cleaner import clean_images, estimate_savings, fetch_candidate_images, fetch_image_ids_in_use, \
+    sweep_snapshots
+from .report import NULL_REPORT_WRITER, ReportWriter
 
 __author__ = "Dan Washusen"
 __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+# botocore's default connection pool size, raised to the worker count when more workers are requested
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
 
 def parse_args(args):
-    parser = argparse.ArgumentParser(description="A tool to clean EC2 AMIs and associated snapshots")
+    parser = argparse.ArgumentParser(
+        description="A tool to clean EC2 AMIs and associated snapshots",
+        fromfile_prefix_chars="@",
+        epilog="Arguments can also be read from a file with one argument per line (e.g. @simple-ami-cleaner.args).",
+    )
 
     parser.add_argument(
         "name_pattern",
-        help="The AMI name patterns (e.g. some*name*amd64*)."
+        nargs="?",
+        help="The AMI name patterns (e.g. some*name*amd64*), required unless --sweep_snapshots is used."
     )
     parser.add_argument(
         "--region",
@@ -48,16 +62,97 @@ def parse_args(args):
              "which will query for AMIs that are associated with running EC2 instances and launch templates (on the "
              "current account).",
     )
+    parser.add_argument(
+        "--all_launch_template_versions",
+        action="store_true",
+        help="Consider AMIs referenced by every launch template version as in use, rather than just the $Latest and "
+             "$Default versions.",
+    )
+    parser.add_argument(
+        "--launch_template_state",
+        type=str,
+        help="The path to a file recording the launch template versions already scanned by "
+             "--all_launch_template_versions so later runs only fetch new versions (use one file per account and "
+             "region).",
+    )
+    parser.add_argument(
+        "--launch_template_rescan_days",
+        type=int,
+        default=7,
+        help="The number of days after which every launch template version is fetched again, forgetting the AMIs of "
+             "deleted versions recorded in --launch_template_state (default 7), use '0' to force a full scan.",
+    )
     parser.add_argument(
         "--print_used_image_ids_and_exit",
         type=str,
         help="Prints a comma separated list of excluded AMI Ids to the specified path and exits.",
     )
+    parser.add_argument(
+        "--estimate_savings_and_exit",
+        type=str,
+        help="Appends the estimated GB-month savings of removing the candidate AMIs' snapshots to the specified "
+             "path and exits.",
+    )
+    parser.add_argument(
+        "--savings_format",
+        choices=["csv", "json"],
+        default="csv",
+        help="The format of the savings estimate, 'csv' (default) or 'json' (one object per line).",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Appends a JSON lines record of every candidate, deletion and failure (including API call durations) "
+             "to the specified path as they happen.",
+    )
     parser.add_argument(
         "--clean",
         action="store_true",
         help="Actually deregister AMIs and delete snapshots.",
     )
+    parser.add_argument(
+        "--sweep_snapshots",
+        action="store_true",
+        help="Delete snapshots created for AMIs that no longer exist (e.g. left behind by failed runs or other "
+             "tools) instead of cleaning AMIs, honours --min_age_days.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="The max number of concurrent delete requests when sweeping snapshots (default 4).",
+    )
+    parser.add_argument(
+        "--retry_mode",
+        choices=["legacy", "standard", "adaptive"],
+        default="adaptive",
+        help="The botocore retry mode (default adaptive), 'adaptive' also rate limits requests when throttled.",
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=3,
+        help="The max number of attempts made for each AWS API request, including the first (default 3), use '1' "
+             "to disable retries.",
+    )
+    parser.add_argument(
+        "--max_pool_connections",
+        type=int,
+        help=f"The max number of connections kept in the client's connection pool, defaults to the greater of "
+             f"{DEFAULT_MAX_POOL_CONNECTIONS} and --workers.",
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        type=float,
+        default=60,
+        help="The number of seconds to wait when establishing a connection (default 60).",
+    )
+    parser.add_argument(
+        "--read_timeout",
+        type=float,
+        default=60,
+        help="The number of seconds to wait when reading from a connection (default 60).",
+    )
     parser.add_argument(
         "--force",
         action="store_true",
@@ -77,7 +172,28 @@ def parse_args(args):
         action="store_const",
         const=logging.DEBUG,
     )
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.name_pattern is None and not parsed_args.sweep_snapshots:
+        parser.error("the following arguments are required: name_pattern")
+    if parsed_args.sweep_snapshots and parsed_args.name_pattern is not None:
+        parser.error("--sweep_snapshots applies to every snapshot in the account and can't be limited by name_pattern")
+    if parsed_args.sweep_snapshots and \
+            (parsed_args.print_used_image_ids_and_exit or parsed_args.estimate_savings_and_exit):
+        parser.error("--sweep_snapshots can't be combined with --print_used_image_ids_and_exit or "
+                     "--estimate_savings_and_exit")
+    if parsed_args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if parsed_args.launch_template_state and not parsed_args.all_launch_template_versions:
+        parser.error("--launch_template_state requires --all_launch_template_versions")
+    if parsed_args.launch_template_rescan_days < 0:
+        parser.error("--launch_template_rescan_days must be at least 0")
+    if parsed_args.max_attempts < 1:
+        parser.error("--max_attempts must be at least 1")
+    if parsed_args.max_pool_connections is not None and parsed_args.max_pool_connections < 1:
+        parser.error("--max_pool_connections must be at least 1")
+
+    return parsed_args
 
 
 def setup_logging(loglevel):
@@ -95,18 +211,40 @@ def setup_logging(loglevel):
     )
 
 
-def create_ec2_client(region):
-    if region is None:
-        return boto3.client("ec2", config=Config(
-                retries={"max_attempts": 3}
-            )
-        )
-    else:
-        return boto3.client("ec2", config=Config(
-                region_name=region,
-                retries={"max_attempts": 3},
-            ),
-        )
+def create_client_config(args):
+    max_pool_connections = args.max_pool_connections or max(DEFAULT_MAX_POOL_CONNECTIONS, args.workers)
+
+    return Config(
+        # botocore's max_attempts counts retries, total_max_attempts includes the initial request
+        retries={"total_max_attempts": args.max_attempts, "mode": args.retry_mode},
+        max_pool_connections=max_pool_connections,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+    )
+
+
+class Ec2ClientFactory:
+    """Creates at most one EC2 client per region, sharing it (and its connection pool) between callers
+
+    boto3 clients are thread safe once created but creating them through the default session is not, so client
+    creation is serialised.
+
+    Args:
+      config (botocore.config.Config): the config applied to every client
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, region=None):
+        with self._lock:
+            if region not in self._clients:
+                _logger.debug(f"Creating EC2 client for region {region or 'default'}")
+                self._clients[region] = boto3.client("ec2", region_name=region, config=self._config)
+
+            return self._clients[region]
 
 
 def print_used_image_ids(args, used_image_ids):
@@ -122,22 +260,134 @@ def print_used_image_ids(args, used_image_ids):
             output_file.write(os.linesep)
 
 
-def fetch_and_print_used_image_ids(ec2_client, args):
+def is_valid_launch_template_state(launch_template_state):
+    if not isinstance(launch_template_state, dict):
+        return False
+
+    if "LastFullScan" in launch_template_state:
+        if not isinstance(launch_template_state["LastFullScan"], str):
+            return False
+        try:
+            if datetime.fromisoformat(launch_template_state["LastFullScan"]).tzinfo is None:
+                return False
+        except ValueError:
+            return False
+
+    launch_templates = launch_template_state.get("LaunchTemplates", {})
+    if not isinstance(launch_templates, dict):
+        return False
+
+    for launch_template in launch_templates.values():
+        if not isinstance(launch_template, dict):
+            return False
+        latest_version_number = launch_template.get("LatestVersionNumber")
+        if not isinstance(latest_version_number, int) or isinstance(latest_version_number, bool):
+            return False
+        image_ids = launch_template.get("ImageIds")
+        if not isinstance(image_ids, dict) or not all(isinstance(image_id, str) for image_id in image_ids.values()):
+            return False
+
+    return True
+
+
+def load_launch_template_state(path):
+    if path is None or not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path) as f:
+            launch_template_state = json.load(f)
+        if is_valid_launch_template_state(launch_template_state):
+            return launch_template_state
+    except ValueError:
+        pass
+
+    _logger.warning(f"Ignoring invalid launch template state in '{path}', all launch template versions will be "
+                    f"fetched")
+    return {}
+
+
+def save_launch_template_state(path, launch_template_state):
+    if path is None:
+        return
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(launch_template_state, f)
+    os.replace(temp_path, path)
+
+
+def fetch_used_image_ids(ec2_client, args):
+    launch_template_state = load_launch_template_state(args.launch_template_state)
+
     used_image_ids = fetch_image_ids_in_use(
         ec2_client=ec2_client,
-        name_pattern=args.name_pattern
+        name_pattern=args.name_pattern,
+        all_launch_template_versions=args.all_launch_template_versions,
+        launch_template_state=launch_template_state,
+        launch_template_rescan_days=args.launch_template_rescan_days,
     )
 
+    if args.all_launch_template_versions:
+        save_launch_template_state(args.launch_template_state, launch_template_state)
+
+    return used_image_ids
+
+
+def fetch_and_print_used_image_ids(ec2_client, args):
+    used_image_ids = fetch_used_image_ids(ec2_client=ec2_client, args=args)
+
     print_used_image_ids(args=args, used_image_ids=used_image_ids)
 
 
+def print_savings(args, savings):
+    _logger.info(f"Printing estimated savings to '{args.estimate_savings_and_exit}'")
+    if "/dev/stdout" == args.estimate_savings_and_exit:  # cross-platform support
+        write_savings(output_file=sys.stdout, savings=savings, savings_format=args.savings_format, header=True)
+    else:
+        header = not os.path.exists(args.estimate_savings_and_exit) or \
+                 os.path.getsize(args.estimate_savings_and_exit) == 0
+        with open(args.estimate_savings_and_exit, "a", newline="") as output_file:
+            write_savings(output_file=output_file, savings=savings, savings_format=args.savings_format, header=header)
+
+
+def write_savings(output_file, savings, savings_format, header):
+    if savings_format == "json":
+        output_file.write(json.dumps(savings))
+        output_file.write(os.linesep)
+    else:
+        writer = csv.DictWriter(output_file, fieldnames=list(savings.keys()))
+        if header:
+            writer.writeheader()
+        writer.writerow(savings)
+
+
+def fetch_and_print_savings(ec2_client, args, excluded_image_ids, report_writer=NULL_REPORT_WRITER):
+    images = fetch_candidate_images(
+        ec2_client=ec2_client,
+        name_pattern=args.name_pattern,
+        keep=args.keep,
+        min_age_days=args.min_age_days,
+        excluded_image_ids=excluded_image_ids,
+        report_writer=report_writer,
+    )
+
+    savings = estimate_savings(
+        ec2_client=ec2_client,
+        images=images,
+        name_pattern=args.name_pattern,
+        region=args.region or ec2_client.meta.region_name,
+        report_writer=report_writer,
+    )
+
+    print_savings(args=args, savings=savings)
+
+
 def load_excluded_image_ids(ec2_client, args):
     excluded_image_ids = set()
 
     if args.exclude_image_ids == "USED":
-        excluded_image_ids = fetch_image_ids_in_use(
-            ec2_client=ec2_client, name_pattern=args.name_pattern
-        )
+        excluded_image_ids = fetch_used_image_ids(ec2_client=ec2_client, args=args)
     else:
         if os.path.exists(args.exclude_image_ids):
             with open(args.exclude_image_ids) as f:
@@ -154,12 +404,41 @@ def load_excluded_image_ids(ec2_client, args):
     return excluded_image_ids
 
 
+def create_report_writer(args):
+    if args.report:
+        return ReportWriter(args.report)
+    else:
+        return NULL_REPORT_WRITER
+
+
 def main(args):
     args = parse_args(args)
 
     setup_logging(args.loglevel)
 
-    ec2_client = create_ec2_client(args.region)
+    if args.report:
+        try:
+            # fail before touching any resources rather than part way through a run
+            with open(args.report, "a"):
+                pass
+        except OSError:
+            _logger.exception(msg=f"An error occurred while attempting to open report {args.report}", exc_info=True)
+            sys.exit(1)
+
+    ec2_client_factory = Ec2ClientFactory(create_client_config(args))
+    ec2_client = ec2_client_factory.client(args.region)
+
+    if args.sweep_snapshots:
+        with create_report_writer(args) as report_writer:
+            failed_snapshot_ids = sweep_snapshots(
+                ec2_client=ec2_client,
+                min_age_days=args.min_age_days,
+                dry_run=not args.clean,
+                force=args.force,
+                max_workers=args.workers,
+                report_writer=report_writer,
+            )
+        sys.exit(1 if failed_snapshot_ids else 0)
 
     if args.print_used_image_ids_and_exit:
         try:
@@ -176,15 +455,32 @@ def main(args):
     if args.exclude_image_ids is not None:
         excluded_image_ids = load_excluded_image_ids(ec2_client=ec2_client, args=args)
 
-    clean_images(
-        ec2_client=ec2_client,
-        name_pattern=args.name_pattern,
-        keep=args.keep,
-        min_age_days=args.min_age_days,
-        excluded_image_ids=excluded_image_ids,
-        dry_run=not args.clean,
-        force=args.force,
-    )
+    if args.estimate_savings_and_exit:
+        try:
+            with create_report_writer(args) as report_writer:
+                fetch_and_print_savings(
+                    ec2_client=ec2_client,
+                    args=args,
+                    excluded_image_ids=excluded_image_ids,
+                    report_writer=report_writer,
+                )
+            sys.exit(0)
+        except OSError:
+            _logger.exception(msg=f"An error occurred while attempting to append to file "
+                                  f"{args.estimate_savings_and_exit}", exc_info=True)
+            sys.exit(1)
+
+    with create_report_writer(args) as report_writer:
+        clean_images(
+            ec2_client=ec2_client,
+            name_pattern=args.name_pattern,
+            keep=args.keep,
+            min_age_days=args.min_age_days,
+            excluded_image_ids=excluded_image_ids,
+            dry_run=not args.clean,
+            force=args.force,
+            report_writer=report_writer,
+        )
     sys.exit(0)
 
 
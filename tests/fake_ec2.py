@@ -0,0 +1,324 @@
+"""
+    A stateful, in-memory stand-in for the boto3 EC2 client used by the benchmarks.
+
+    Only the operations (and parameters) used by simple_ami_cleaner are implemented. List operations return
+    everything unless MaxResults is given, paginators always request EC2's max page size.
+"""
+import fnmatch
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from simple_ami_cleaner.ami_cleaner import format_date
+
+__author__ = "Dan Washusen"
+__license__ = "MIT"
+
+# EC2's max page size for each paginated operation
+PAGE_SIZES = {
+    "describe_images": 1000,
+    "describe_instances": 1000,
+    "describe_launch_templates": 200,
+    "describe_launch_template_versions": 200,
+    "describe_snapshots": 1000,
+}
+
+
+def client_error(code, operation_name):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation_name)
+
+
+class FakeMeta:
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+class FakePaginator:
+    def __init__(self, ec2_client, operation_name):
+        self._ec2_client = ec2_client
+        self._operation_name = operation_name
+
+    def paginate(self, **kwargs):
+        operation = getattr(self._ec2_client, self._operation_name)
+        kwargs.setdefault("MaxResults", PAGE_SIZES[self._operation_name])
+        next_token = None
+        while True:
+            if next_token:
+                page = operation(NextToken=next_token, **kwargs)
+            else:
+                page = operation(**kwargs)
+            yield page
+            next_token = page.get("NextToken")
+            if not next_token:
+                return
+
+
+class FakeEc2Client:
+    """An in-memory EC2 client
+
+    Args:
+      images (list): AMIs in describe_images format
+      instances (list): instances in describe_instances format (without reservations)
+      launch_template_versions (list): versions in describe_launch_template_versions format
+      snapshots (list): snapshots in describe_snapshots format
+      latency (float): seconds slept by every API call
+      throttle_every (int): throttle every n-th API call, 0 disables throttling
+      max_attempts (int): attempts made per call before a throttling error is raised, emulates botocore's retries
+      region_name (str): the region reported by ``meta.region_name``
+    """
+
+    def __init__(
+            self,
+            images=None,
+            instances=None,
+            launch_template_versions=None,
+            snapshots=None,
+            latency=0.0,
+            throttle_every=0,
+            max_attempts=3,
+            region_name="us-east-1",
+    ):
+        self.images = {image["ImageId"]: image for image in images or []}
+        self.instances = list(instances or [])
+        self.launch_template_versions = sorted(
+            launch_template_versions or [],
+            key=lambda version: (version["LaunchTemplateId"], version["VersionNumber"]),
+        )
+        self.snapshots = {snapshot["SnapshotId"]: snapshot for snapshot in snapshots or []}
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.max_attempts = max_attempts
+        self.meta = FakeMeta(region_name)
+
+        self.api_calls = Counter()
+        self.throttled_calls = Counter()
+        self._call_count = 0
+        self._lock = threading.Lock()
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self, operation_name)
+
+    def _call(self, operation_name):
+        for _ in range(self.max_attempts):
+            with self._lock:
+                self._call_count = self._call_count + 1
+                self.api_calls[operation_name] += 1
+                throttled = self.throttle_every > 0 and self._call_count % self.throttle_every == 0
+                if throttled:
+                    self.throttled_calls[operation_name] += 1
+
+            if self.latency:
+                time.sleep(self.latency)
+
+            if not throttled:
+                return
+
+        raise client_error("RequestLimitExceeded", operation_name)
+
+    @staticmethod
+    def _page(operation_name, items, key, NextToken=None, MaxResults=None):
+        # like EC2, everything is returned in a single response unless the caller asks for pages
+        if NextToken is None and MaxResults is None:
+            return {key: items}
+
+        start = int(NextToken or 0)
+        end = start + min(MaxResults or PAGE_SIZES[operation_name], PAGE_SIZES[operation_name])
+        page = {key: items[start:end]}
+        if end < len(items):
+            page["NextToken"] = str(end)
+        return page
+
+    @staticmethod
+    def _filter_values(filters, name):
+        for item_filter in filters or []:
+            if item_filter["Name"] == name:
+                return item_filter["Values"]
+        return None
+
+    def describe_images(self, Owners=None, ImageIds=None, Filters=None, IncludeDeprecated=False,
+                        IncludeDisabled=False, NextToken=None, MaxResults=None):
+        self._call("describe_images")
+
+        if ImageIds is not None:
+            missing_image_ids = [image_id for image_id in ImageIds if image_id not in self.images]
+            if missing_image_ids:
+                raise client_error("InvalidAMIID.NotFound", "DescribeImages")
+            return {"Images": [self.images[image_id] for image_id in ImageIds]}
+
+        images = list(self.images.values())
+        name_patterns = self._filter_values(Filters, "name")
+        if name_patterns is not None:
+            images = [
+                image for image in images
+                if any(fnmatch.fnmatch(image["Name"], name_pattern) for name_pattern in name_patterns)
+            ]
+
+        return self._page("describe_images", images, "Images", NextToken, MaxResults)
+
+    def describe_instances(self, Filters=None, NextToken=None, MaxResults=None):
+        self._call("describe_instances")
+
+        instances = self.instances
+        states = self._filter_values(Filters, "instance-state-name")
+        if states is not None:
+            instances = [instance for instance in instances if instance["State"]["Name"] in states]
+
+        page = self._page("describe_instances", instances, "Reservations", NextToken, MaxResults)
+        page["Reservations"] = [{"Instances": [instance]} for instance in page["Reservations"]]
+        return page
+
+    def describe_launch_templates(self, NextToken=None, MaxResults=None):
+        self._call("describe_launch_templates")
+
+        latest_versions = {}
+        for version in self.launch_template_versions:
+            latest_versions[version["LaunchTemplateId"]] = version["VersionNumber"]
+        launch_templates = [
+            {"LaunchTemplateId": launch_template_id, "LatestVersionNumber": latest_version_number}
+            for launch_template_id, latest_version_number in latest_versions.items()
+        ]
+
+        return self._page("describe_launch_templates", launch_templates, "LaunchTemplates", NextToken, MaxResults)
+
+    def describe_launch_template_versions(self, LaunchTemplateId=None, Versions=None, MinVersion=None,
+                                          MaxVersion=None, NextToken=None, MaxResults=None):
+        self._call("describe_launch_template_versions")
+
+        versions = self.launch_template_versions
+        if LaunchTemplateId is not None:
+            versions = [version for version in versions if version["LaunchTemplateId"] == LaunchTemplateId]
+        if MinVersion is not None:
+            versions = [version for version in versions if version["VersionNumber"] >= int(MinVersion)]
+        if MaxVersion is not None:
+            versions = [version for version in versions if version["VersionNumber"] <= int(MaxVersion)]
+        if Versions is not None:
+            latest_versions = {}
+            for version in versions:
+                latest_versions[version["LaunchTemplateId"]] = version["VersionNumber"]
+            versions = [
+                version for version in versions
+                if ("$Latest" in Versions and latest_versions[version["LaunchTemplateId"]] == version["VersionNumber"])
+                or ("$Default" in Versions and version.get("DefaultVersion"))
+                or str(version["VersionNumber"]) in Versions
+            ]
+
+        return self._page(
+            "describe_launch_template_versions", versions, "LaunchTemplateVersions", NextToken, MaxResults
+        )
+
+    def describe_snapshots(self, OwnerIds=None, SnapshotIds=None, Filters=None, NextToken=None, MaxResults=None):
+        self._call("describe_snapshots")
+
+        if SnapshotIds is not None:
+            missing_snapshot_ids = [snapshot_id for snapshot_id in SnapshotIds if snapshot_id not in self.snapshots]
+            if missing_snapshot_ids:
+                raise client_error("InvalidSnapshot.NotFound", "DescribeSnapshots")
+            return {"Snapshots": [self.snapshots[snapshot_id] for snapshot_id in SnapshotIds]}
+
+        snapshots = list(self.snapshots.values())
+        snapshot_ids = self._filter_values(Filters, "snapshot-id")
+        if snapshot_ids is not None:
+            snapshots = [snapshot for snapshot in snapshots if snapshot["SnapshotId"] in snapshot_ids]
+
+        return self._page("describe_snapshots", snapshots, "Snapshots", NextToken, MaxResults)
+
+    def deregister_image(self, ImageId):
+        self._call("deregister_image")
+
+        with self._lock:
+            if self.images.pop(ImageId, None) is None:
+                raise client_error("InvalidAMIID.NotFound", "DeregisterImage")
+
+    def delete_snapshot(self, SnapshotId):
+        self._call("delete_snapshot")
+
+        with self._lock:
+            if self.snapshots.pop(SnapshotId, None) is None:
+                raise client_error("InvalidSnapshot.NotFound", "DeleteSnapshot")
+
+
+def generate_fixtures(
+        image_count=100_000,
+        instance_count=50_000,
+        launch_template_version_count=10_000,
+        versions_per_launch_template=10,
+        in_use_image_count=1_000,
+        orphaned_snapshot_count=10_000,
+        image_name_prefixes=50,
+        seed=0,
+):
+    """Generates synthetic images (each with a root and data volume snapshot), instances, launch template versions
+    and orphaned snapshots, returned as keyword arguments for :class:`FakeEc2Client`.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+
+    def ec2_id(prefix, index):
+        return f"{prefix}-{index:017x}"
+
+    images = []
+    snapshots = []
+    for index in range(image_count):
+        image_id = ec2_id("ami", index)
+        creation_date = now - timedelta(days=rng.randint(0, 730), seconds=rng.randint(0, 86_400))
+        block_device_mappings = []
+        for volume_index, device_name in enumerate(["/dev/xvda", "/dev/xvdb"]):
+            snapshot_id = ec2_id("snap", index * 2 + volume_index)
+            volume_size = rng.choice([8, 16, 30, 100])
+            block_device_mappings.append(
+                {"DeviceName": device_name, "Ebs": {"SnapshotId": snapshot_id, "VolumeSize": volume_size}}
+            )
+            snapshots.append({
+                "SnapshotId": snapshot_id,
+                "State": "completed",
+                "StartTime": creation_date,
+                "VolumeSize": volume_size,
+                "Description": f"Created by CreateImage({ec2_id('i', index)}) for {image_id}",
+            })
+        images.append({
+            "ImageId": image_id,
+            "Name": f"app-{index % image_name_prefixes}-amd64-{creation_date:%Y%m%d%H%M%S}-{index}",
+            "CreationDate": format_date(creation_date.replace(tzinfo=None)),
+            "BlockDeviceMappings": block_device_mappings,
+        })
+
+    for index in range(orphaned_snapshot_count):
+        snapshots.append({
+            "SnapshotId": ec2_id("snap", image_count * 2 + index),
+            "State": "completed",
+            "StartTime": now - timedelta(days=rng.randint(0, 730)),
+            "VolumeSize": 8,
+            "Description": f"Created by CreateImage({ec2_id('i', index)}) for {ec2_id('ami', image_count + index)}",
+        })
+
+    in_use_image_ids = [image["ImageId"] for image in rng.sample(images, min(in_use_image_count, image_count))]
+
+    instances = [
+        {
+            "InstanceId": ec2_id("i", index),
+            "ImageId": rng.choice(in_use_image_ids),
+            "State": {"Name": rng.choice(["running", "running", "stopped", "terminated"])},
+        }
+        for index in range(instance_count)
+    ]
+
+    launch_template_versions = []
+    for index in range(launch_template_version_count):
+        version_number = index % versions_per_launch_template + 1
+        launch_template_versions.append({
+            "LaunchTemplateId": ec2_id("lt", index // versions_per_launch_template),
+            "VersionNumber": version_number,
+            "DefaultVersion": version_number == 1,
+            "LaunchTemplateData": {"ImageId": rng.choice(in_use_image_ids)},
+        })
+
+    return {
+        "images": images,
+        "instances": instances,
+        "launch_template_versions": launch_template_versions,
+        "snapshots": snapshots,
+    }
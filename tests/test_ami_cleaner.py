@@ -1,8 +1,15 @@
 import pytest
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+from fake_ec2 import FakeEc2Client
 
 from simple_ami_cleaner.ami_cleaner import sort_images_by_creation_date_asc, \
-    filter_images_by_age, filter_images_by_excluded, filter_images_by_keep, filter_images, format_date, check_name_match
+    filter_images_by_age, filter_images_by_excluded, filter_images_by_keep, filter_images, format_date, \
+    check_name_match, filter_orphaned_snapshots, filter_snapshots_by_age, fetch_snapshot_volume_sizes, \
+    estimate_savings, fetch_image_ids_in_use_by_all_launch_template_versions, fetch_snapshot_ids_in_use_by_images, \
+    sweep_snapshots, delete_snapshots
 
 __author__ = "Dan Washusen"
 __license__ = "MIT"
@@ -243,3 +250,286 @@ def test_check_name_match():
         image_name="something-blah-amd64-20221004021208",
         name_pattern="something*blah-*arm64*"
     ) is False
+
+
+def test_filter_orphaned_snapshots():
+    now = datetime.now(timezone.utc)
+    snapshots = [
+        {
+            "SnapshotId": "snap-123",
+            "State": "completed",
+            "StartTime": now,
+            "Description": "Created by CreateImage(i-0a1b2c3d) for ami-0123456789abcdef0"
+        },
+        {
+            "SnapshotId": "snap-124",
+            "State": "completed",
+            "StartTime": now,
+            "Description": "Created by CreateImage(i-0a1b2c3d) for ami-0123456789abcdef1"
+        },
+        {
+            "SnapshotId": "snap-125",
+            "State": "completed",
+            "StartTime": now,
+            "Description": "Copied for DestinationAmi ami-0123456789abcdef2 from SourceAmi ami-0a1b2c3d"
+        },
+        {
+            "SnapshotId": "snap-126",
+            "State": "pending",
+            "StartTime": now,
+            "Description": "Created by CreateImage(i-0a1b2c3d) for ami-0123456789abcdef3"
+        },
+        {
+            "SnapshotId": "snap-127",
+            "State": "completed",
+            "StartTime": now,
+            "Description": "Nightly database volume backup"
+        },
+    ]
+
+    orphaned_snapshots = filter_orphaned_snapshots(snapshots=snapshots, snapshot_ids_in_use={"snap-123"})
+
+    assert [snapshot["SnapshotId"] for snapshot in orphaned_snapshots] == ["snap-124", "snap-125"]
+
+
+def test_filter_snapshots_by_age():
+    now = datetime.now(timezone.utc)
+    snapshots = [
+        {
+            "SnapshotId": "snap-123",
+            "StartTime": now - timedelta(days=10)
+        },
+        {
+            "SnapshotId": "snap-124",
+            "StartTime": now
+        },
+    ]
+
+    filtered_snapshots, filter_count = filter_snapshots_by_age(snapshots=snapshots, min_age_days=3)
+
+    assert [snapshot["SnapshotId"] for snapshot in filtered_snapshots] == ["snap-123"]
+    assert filter_count == 1
+
+    filtered_snapshots, filter_count = filter_snapshots_by_age(snapshots=snapshots, min_age_days=-1)
+
+    assert len(filtered_snapshots) == len(snapshots)
+
+
+def ami_snapshot(snapshot_id, image_id, age_days=100):
+    return {
+        "SnapshotId": snapshot_id,
+        "State": "completed",
+        "StartTime": datetime.now(timezone.utc) - timedelta(days=age_days),
+        "VolumeSize": 8,
+        "Description": f"Created by CreateImage(i-0a1b2c3d) for {image_id}",
+    }
+
+
+class FailingDeleteEc2Client(FakeEc2Client):
+    def __init__(self, failing_snapshot_ids, **kwargs):
+        super().__init__(**kwargs)
+        self.failing_snapshot_ids = failing_snapshot_ids
+
+    def delete_snapshot(self, SnapshotId):
+        if SnapshotId in self.failing_snapshot_ids:
+            self._call("delete_snapshot")
+            raise ClientError({"Error": {"Code": "InvalidSnapshot.InUse", "Message": "in use"}}, "DeleteSnapshot")
+        super().delete_snapshot(SnapshotId=SnapshotId)
+
+
+def test_fetch_snapshot_ids_in_use_by_images_reads_every_page():
+    ec2_client = FakeEc2Client(images=[
+        {
+            "ImageId": f"ami-{index}",
+            "BlockDeviceMappings": [
+                {"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": f"snap-{index}"}},
+                {"DeviceName": "/dev/xvdb", "VirtualName": "ephemeral0"},
+            ]
+        }
+        for index in range(2500)
+    ])
+
+    snapshot_ids = fetch_snapshot_ids_in_use_by_images(ec2_client=ec2_client)
+
+    assert snapshot_ids == {f"snap-{index}" for index in range(2500)}
+    assert ec2_client.api_calls["describe_images"] == 3
+
+
+def test_sweep_snapshots_only_deletes_orphaned_ami_snapshots():
+    manual_snapshot = ami_snapshot("snap-125", "ami-0123456789abcdef2")
+    manual_snapshot["Description"] = "Nightly database volume backup"
+    ec2_client = FakeEc2Client(
+        images=[
+            {
+                "ImageId": "ami-0123456789abcdef0",
+                "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-123"}}],
+            },
+        ],
+        snapshots=[
+            ami_snapshot("snap-123", "ami-0123456789abcdef0"),
+            ami_snapshot("snap-124", "ami-0123456789abcdef1"),
+            manual_snapshot,
+            ami_snapshot("snap-126", "ami-0123456789abcdef3", age_days=1),
+        ],
+    )
+
+    failed_snapshot_ids = sweep_snapshots(ec2_client=ec2_client, min_age_days=90, force=True, dry_run=False)
+
+    assert failed_snapshot_ids == []
+    assert set(ec2_client.snapshots.keys()) == {"snap-123", "snap-125", "snap-126"}
+
+
+def test_sweep_snapshots_dry_run_deletes_nothing():
+    ec2_client = FakeEc2Client(snapshots=[ami_snapshot("snap-124", "ami-0123456789abcdef1")])
+
+    sweep_snapshots(ec2_client=ec2_client, min_age_days=90, force=True, dry_run=True)
+
+    assert set(ec2_client.snapshots.keys()) == {"snap-124"}
+    assert ec2_client.api_calls["delete_snapshot"] == 0
+
+
+def test_delete_snapshots_collects_failures():
+    snapshots = [ami_snapshot(f"snap-{index}", f"ami-{index}") for index in range(20)]
+    ec2_client = FailingDeleteEc2Client(failing_snapshot_ids={"snap-3", "snap-17"}, snapshots=snapshots)
+
+    failed_snapshot_ids = delete_snapshots(ec2_client=ec2_client, snapshots=snapshots, dry_run=False, max_workers=4)
+
+    assert sorted(failed_snapshot_ids) == ["snap-17", "snap-3"]
+    assert set(ec2_client.snapshots.keys()) == {"snap-3", "snap-17"}
+    assert ec2_client.api_calls["delete_snapshot"] == 20
+
+
+def test_fetch_snapshot_volume_sizes_batches_requests():
+    ec2_client = FakeEc2Client(snapshots=[{"SnapshotId": f"snap-{index}", "VolumeSize": index} for index in range(5)])
+
+    volume_sizes = fetch_snapshot_volume_sizes(
+        ec2_client=ec2_client, snapshot_ids=[f"snap-{index}" for index in range(5)], batch_size=2
+    )
+
+    assert volume_sizes == {f"snap-{index}": index for index in range(5)}
+    assert ec2_client.api_calls["describe_snapshots"] == 3
+
+
+def test_fetch_snapshot_volume_sizes_skips_missing_snapshots():
+    ec2_client = FakeEc2Client(snapshots=[
+        {"SnapshotId": "snap-123", "VolumeSize": 8},
+        {"SnapshotId": "snap-125", "VolumeSize": 30},
+    ])
+
+    volume_sizes = fetch_snapshot_volume_sizes(
+        ec2_client=ec2_client, snapshot_ids=["snap-123", "snap-124", "snap-125"]
+    )
+
+    assert volume_sizes == {"snap-123": 8, "snap-125": 30}
+    assert ec2_client.api_calls["describe_snapshots"] == 1
+
+
+def test_estimate_savings():
+    ec2_client = FakeEc2Client(snapshots=[
+        {"SnapshotId": "snap-123", "VolumeSize": 8},
+        {"SnapshotId": "snap-124", "VolumeSize": 30},
+    ])
+    images = [
+        {
+            "ImageId": "abc123",
+            "BlockDeviceMappings": [
+                {"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-123"}},
+                {"DeviceName": "/dev/xvdb", "Ebs": {"SnapshotId": "snap-124"}},
+                {"DeviceName": "/dev/xvdc", "VirtualName": "ephemeral0"},
+            ]
+        },
+        {
+            "ImageId": "abc124",
+            "BlockDeviceMappings": [
+                {"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-123"}},
+            ]
+        },
+    ]
+
+    savings = estimate_savings(ec2_client=ec2_client, images=images, name_pattern="my-*", region="us-east-1")
+
+    assert savings == {
+        "name_pattern": "my-*",
+        "region": "us-east-1",
+        "image_count": 2,
+        "snapshot_count": 2,
+        "missing_snapshot_count": 0,
+        "estimated_gb_month_savings": 38,
+    }
+    assert ec2_client.api_calls["describe_snapshots"] == 1
+
+
+def test_fetch_image_ids_in_use_by_all_launch_template_versions_only_fetches_new_versions():
+    ec2_client = FakeEc2Client(launch_template_versions=[
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 1, "LaunchTemplateData": {"ImageId": "abc123"}},
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 2, "LaunchTemplateData": {}},
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 3, "LaunchTemplateData": {"ImageId": "abc124"}},
+        {"LaunchTemplateId": "lt-124", "VersionNumber": 1, "LaunchTemplateData": {"ImageId": "abc125"}},
+    ])
+    launch_template_state = {}
+
+    image_ids = fetch_image_ids_in_use_by_all_launch_template_versions(
+        ec2_client=ec2_client, launch_template_state=launch_template_state
+    )
+
+    assert image_ids == {"abc123", "abc124", "abc125"}
+    assert launch_template_state["LaunchTemplates"]["lt-123"]["LatestVersionNumber"] == 3
+    assert ec2_client.api_calls["describe_launch_template_versions"] == 2
+
+    ec2_client.launch_template_versions = ec2_client.launch_template_versions[:-1] + [
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 4, "LaunchTemplateData": {"ImageId": "abc126"}},
+    ]
+
+    image_ids = fetch_image_ids_in_use_by_all_launch_template_versions(
+        ec2_client=ec2_client, launch_template_state=launch_template_state
+    )
+
+    assert image_ids == {"abc123", "abc124", "abc126"}
+    assert "lt-124" not in launch_template_state["LaunchTemplates"]
+    assert ec2_client.api_calls["describe_launch_template_versions"] == 3
+
+
+def test_fetch_image_ids_in_use_by_all_launch_template_versions_rescan_forgets_deleted_versions():
+    ec2_client = FakeEc2Client(launch_template_versions=[
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 1, "LaunchTemplateData": {"ImageId": "abc123"}},
+        {"LaunchTemplateId": "lt-123", "VersionNumber": 2, "LaunchTemplateData": {"ImageId": "abc124"}},
+    ])
+    launch_template_state = {}
+
+    fetch_image_ids_in_use_by_all_launch_template_versions(
+        ec2_client=ec2_client, launch_template_state=launch_template_state
+    )
+
+    ec2_client.launch_template_versions = ec2_client.launch_template_versions[1:]
+
+    image_ids = fetch_image_ids_in_use_by_all_launch_template_versions(
+        ec2_client=ec2_client, launch_template_state=launch_template_state
+    )
+
+    assert image_ids == {"abc123", "abc124"}
+
+    image_ids = fetch_image_ids_in_use_by_all_launch_template_versions(
+        ec2_client=ec2_client, launch_template_state=launch_template_state, rescan_days=0
+    )
+
+    assert image_ids == {"abc124"}
+    assert launch_template_state["LaunchTemplates"]["lt-123"]["ImageIds"] == {"2": "abc124"}
+
+
+def test_sweep_snapshots_lists_snapshots_before_images():
+    class CreatingImageEc2Client(FakeEc2Client):
+        # an AMI (and its snapshot) is created right after the first call
+        def _call(self, operation_name):
+            super()._call(operation_name)
+            if sum(self.api_calls.values()) == 1:
+                self.snapshots["snap-124"] = ami_snapshot("snap-124", "ami-0123456789abcdef1", age_days=0)
+                self.images["ami-0123456789abcdef1"] = {
+                    "ImageId": "ami-0123456789abcdef1",
+                    "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-124"}}],
+                }
+
+    ec2_client = CreatingImageEc2Client(snapshots=[ami_snapshot("snap-123", "ami-0123456789abcdef0")])
+
+    sweep_snapshots(ec2_client=ec2_client, min_age_days=-1, force=True, dry_run=False)
+
+    assert set(ec2_client.snapshots.keys()) == {"snap-124"}
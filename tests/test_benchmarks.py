@@ -0,0 +1,179 @@
+"""
+    Offline benchmarks of the end-to-end pipelines against the in-memory fake EC2 client.
+
+    The benchmarks are deselected by default, run them with:
+
+        pytest -m benchmark
+
+    AMI_CLEANER_BENCHMARK_SCALE scales the fixture sizes (default 1.0, i.e. 100k AMIs, 50k instances and 10k
+    launch template versions). AMI_CLEANER_BENCHMARK_MAX_SECONDS (default 45) and AMI_CLEANER_BENCHMARK_MAX_MIB
+    (default 48) set the wall time and peak traced memory budgets of each benchmark at a scale of 1.0, they are
+    scaled along with the fixtures.
+"""
+import logging
+import math
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from fake_ec2 import FakeEc2Client, generate_fixtures, PAGE_SIZES
+from simple_ami_cleaner.ami_cleaner import clean_images, fetch_image_ids_in_use, sweep_snapshots
+
+__author__ = "Dan Washusen"
+__license__ = "MIT"
+
+_logger = logging.getLogger(__name__)
+
+SCALE = float(os.environ.get("AMI_CLEANER_BENCHMARK_SCALE", "1.0"))
+# at least 5s and 4 MiB so tiny scales aren't dominated by fixed costs
+MAX_SECONDS = max(5.0, float(os.environ.get("AMI_CLEANER_BENCHMARK_MAX_SECONDS", "45")) * SCALE)
+MAX_MEMORY = max(4.0, float(os.environ.get("AMI_CLEANER_BENCHMARK_MAX_MIB", "48")) * SCALE) * 1024 * 1024
+
+
+def scaled(count):
+    return max(1, int(count * SCALE))
+
+
+def page_count(item_count, operation_name):
+    return max(1, math.ceil(item_count / PAGE_SIZES[operation_name]))
+
+
+def measure(name, ec2_client, function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+        wall_time = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    _logger.info(
+        f"Benchmark {name}: wall time {wall_time:.2f}s, peak memory {peak_memory / 1024 / 1024:.1f} MiB, "
+        f"{sum(ec2_client.api_calls.values())} API calls {dict(ec2_client.api_calls)}, "
+        f"{sum(ec2_client.throttled_calls.values())} throttled"
+    )
+
+    return result, wall_time, peak_memory
+
+
+@pytest.fixture(scope="module")
+def fixtures():
+    return generate_fixtures(
+        image_count=scaled(100_000),
+        instance_count=scaled(50_000),
+        launch_template_version_count=scaled(10_000),
+        in_use_image_count=scaled(1_000),
+        orphaned_snapshot_count=scaled(10_000),
+    )
+
+
+@pytest.fixture(autouse=True)
+def quiet_logging(caplog):
+    # logging every AMI would dominate the measurements
+    caplog.set_level(logging.WARNING, logger="simple_ami_cleaner")
+
+
+def in_use_image_ids(fixtures):
+    image_ids = set()
+    for instance in fixtures["instances"]:
+        if instance["State"]["Name"] != "terminated":
+            image_ids.add(instance["ImageId"])
+    for version in fixtures["launch_template_versions"]:
+        image_ids.add(version["LaunchTemplateData"]["ImageId"])
+    return image_ids
+
+
+@pytest.mark.benchmark
+def test_fetch_image_ids_in_use_benchmark(fixtures):
+    ec2_client = FakeEc2Client(**fixtures)
+
+    used_image_ids, wall_time, peak_memory = measure(
+        "fetch_image_ids_in_use",
+        ec2_client,
+        lambda: fetch_image_ids_in_use(ec2_client=ec2_client, name_pattern="app-*"),
+    )
+
+    running_instance_count = sum(1 for instance in fixtures["instances"] if instance["State"]["Name"] != "terminated")
+
+    assert used_image_ids
+    assert ec2_client.api_calls["describe_instances"] == page_count(running_instance_count, "describe_instances")
+    assert ec2_client.api_calls["describe_images"] <= len(in_use_image_ids(fixtures))
+    assert wall_time < MAX_SECONDS
+    assert peak_memory < MAX_MEMORY
+
+
+@pytest.mark.benchmark
+def test_clean_images_benchmark(fixtures):
+    ec2_client = FakeEc2Client(**fixtures)
+
+    def pipeline():
+        excluded_image_ids = fetch_image_ids_in_use(ec2_client=ec2_client, name_pattern="app-*")
+        clean_images(
+            ec2_client=ec2_client,
+            name_pattern="app-*",
+            min_age_days=90,
+            keep=3,
+            excluded_image_ids=excluded_image_ids,
+            force=True,
+            dry_run=False,
+        )
+        return excluded_image_ids
+
+    excluded_image_ids, wall_time, peak_memory = measure("clean_images", ec2_client, pipeline)
+
+    removed_image_count = len(fixtures["images"]) - len(ec2_client.images)
+    assert removed_image_count > 0
+    assert excluded_image_ids.issubset(ec2_client.images.keys())
+    assert ec2_client.api_calls["deregister_image"] == removed_image_count
+    assert ec2_client.api_calls["delete_snapshot"] == removed_image_count * 2
+    assert wall_time < MAX_SECONDS
+    assert peak_memory < MAX_MEMORY
+
+
+@pytest.mark.benchmark
+def test_sweep_snapshots_benchmark(fixtures):
+    ec2_client = FakeEc2Client(**fixtures)
+
+    failed_snapshot_ids, wall_time, peak_memory = measure(
+        "sweep_snapshots",
+        ec2_client,
+        lambda: sweep_snapshots(ec2_client=ec2_client, min_age_days=90, force=True, dry_run=False, max_workers=8),
+    )
+
+    assert failed_snapshot_ids == []
+    assert ec2_client.api_calls["describe_images"] == page_count(len(fixtures["images"]), "describe_images")
+    assert ec2_client.api_calls["describe_snapshots"] == page_count(
+        len(fixtures["snapshots"]), "describe_snapshots"
+    )
+    assert 0 < ec2_client.api_calls["delete_snapshot"] <= scaled(10_000)
+    assert wall_time < MAX_SECONDS
+    assert peak_memory < MAX_MEMORY
+
+
+def test_clean_images_with_latency_and_throttling():
+    fixtures = generate_fixtures(
+        image_count=300,
+        instance_count=150,
+        launch_template_version_count=30,
+        in_use_image_count=10,
+        orphaned_snapshot_count=30,
+    )
+    ec2_client = FakeEc2Client(latency=0.0001, throttle_every=7, max_attempts=3, **fixtures)
+
+    excluded_image_ids = fetch_image_ids_in_use(ec2_client=ec2_client, name_pattern="app-1*")
+    clean_images(
+        ec2_client=ec2_client,
+        name_pattern="app-1*",
+        min_age_days=90,
+        keep=3,
+        excluded_image_ids=excluded_image_ids,
+        force=True,
+        dry_run=False,
+    )
+
+    assert sum(ec2_client.throttled_calls.values()) > 0
+    assert excluded_image_ids.issubset(ec2_client.images.keys())
+    assert ec2_client.api_calls["deregister_image"] == len(fixtures["images"]) - len(ec2_client.images)
@@ -0,0 +1,162 @@
+import json
+import threading
+from datetime import datetime, timezone
+
+import pytest
+from botocore.exceptions import ReadTimeoutError
+
+from fake_ec2 import FakeEc2Client
+from simple_ami_cleaner.ami_cleaner import clean_images, format_date, delete_snapshot, sweep_snapshots
+from simple_ami_cleaner.report import ReportWriter
+
+__author__ = "Dan Washusen"
+__license__ = "MIT"
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_report_writer_writes_records_from_all_threads(tmp_path):
+    report_path = tmp_path / "report.jsonl"
+
+    with ReportWriter(str(report_path), batch_size=7, flush_interval=0.01) as report_writer:
+        threads = [
+            threading.Thread(
+                target=lambda worker: [
+                    report_writer.record("deleted", worker=worker, index=index) for index in range(50)
+                ],
+                args=(worker,),
+            )
+            for worker in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    records = read_records(report_path)
+
+    assert len(records) == 200
+    assert {(record["worker"], record["index"]) for record in records} == {
+        (worker, index) for worker in range(4) for index in range(50)
+    }
+    assert all(record["event"] == "deleted" and "timestamp" in record for record in records)
+
+
+def test_clean_images_reports_candidates_deletions_and_failures(tmp_path):
+    report_path = tmp_path / "report.jsonl"
+    ec2_client = FakeEc2Client(
+        images=[
+            {
+                "ImageId": "abc123",
+                "Name": "my-image-1",
+                "CreationDate": format_date(datetime(2021, 1, 20)),
+                "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-123"}}],
+            },
+            {
+                "ImageId": "abc124",
+                "Name": "my-image-2",
+                "CreationDate": format_date(datetime(2021, 1, 21)),
+                "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": "snap-124"}}],
+            },
+        ],
+        snapshots=[{"SnapshotId": "snap-123"}],
+    )
+
+    with ReportWriter(str(report_path)) as report_writer:
+        with pytest.raises(Exception, match="Failed deleting snapshot snap-124"):
+            clean_images(
+                ec2_client=ec2_client,
+                name_pattern="my-*",
+                min_age_days=-1,
+                keep=-1,
+                force=True,
+                dry_run=False,
+                report_writer=report_writer,
+            )
+
+    records = read_records(report_path)
+
+    assert records[0]["event"] == "api_call"
+    assert records[0]["operation"] == "describe_images"
+    assert records[0]["item_count"] == 2
+
+    records = [
+        (record["event"], record["resource_type"], record["resource_id"]) for record in records[1:]
+    ]
+
+    assert records == [
+        ("candidate", "image", "abc123"),
+        ("candidate", "image", "abc124"),
+        ("deleted", "image", "abc123"),
+        ("deleted", "snapshot", "snap-123"),
+        ("deleted", "image", "abc124"),
+        ("failed", "snapshot", "snap-124"),
+    ]
+    assert all("duration_seconds" in record for record in read_records(report_path)[3:])
+
+
+def test_report_writer_batches_records(tmp_path, monkeypatch):
+    batch_sizes = []
+    report_writer = ReportWriter(str(tmp_path / "report.jsonl"), batch_size=4, flush_interval=10)
+    monkeypatch.setattr(report_writer, "_write", lambda batch: batch_sizes.append(len(batch)))
+
+    with report_writer:
+        for index in range(10):
+            report_writer.record("deleted", index=index)
+
+    assert batch_sizes == [4, 4, 2]
+
+
+def test_report_writer_writes_partial_batches_after_flush_interval(tmp_path):
+    report_path = tmp_path / "report.jsonl"
+
+    with ReportWriter(str(report_path), batch_size=100, flush_interval=0.01) as report_writer:
+        report_writer.record("deleted", index=0)
+        for _ in range(100):
+            if report_path.read_text():
+                break
+            threading.Event().wait(0.01)
+
+        assert len(read_records(report_path)) == 1
+
+
+def test_sweep_snapshots_dry_run_reports_would_delete(tmp_path):
+    report_path = tmp_path / "report.jsonl"
+    ec2_client = FakeEc2Client(snapshots=[
+        {
+            "SnapshotId": "snap-123",
+            "State": "completed",
+            "StartTime": datetime(2021, 1, 20, tzinfo=timezone.utc),
+            "Description": "Created by CreateImage(i-0a1b2c3d) for ami-0123456789abcdef0",
+        },
+    ])
+
+    with ReportWriter(str(report_path)) as report_writer:
+        sweep_snapshots(ec2_client=ec2_client, min_age_days=90, force=True, dry_run=True, report_writer=report_writer)
+
+    records = read_records(report_path)
+
+    assert [record["event"] for record in records] == ["api_call", "api_call", "candidate", "would_delete"]
+    assert records[2]["start_time"] == "2021-01-20T00:00:00+00:00"
+
+
+def test_delete_snapshot_reports_botocore_errors(tmp_path):
+    report_path = tmp_path / "report.jsonl"
+
+    class TimingOutEc2Client(FakeEc2Client):
+        def delete_snapshot(self, SnapshotId):
+            raise ReadTimeoutError(endpoint_url="https://ec2.us-east-1.amazonaws.com")
+
+    with ReportWriter(str(report_path)) as report_writer:
+        with pytest.raises(Exception, match="Failed deleting snapshot snap-123"):
+            delete_snapshot(
+                ec2_client=TimingOutEc2Client(), snapshot_id="snap-123", dry_run=False, report_writer=report_writer
+            )
+
+    records = read_records(report_path)
+
+    assert [(record["event"], record["resource_id"]) for record in records] == [("failed", "snap-123")]
+    assert "duration_seconds" in records[0]
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+import simple_ami_cleaner.skeleton
+from simple_ami_cleaner.skeleton import main, parse_args, create_client_config, Ec2ClientFactory, \
+    load_launch_template_state, save_launch_template_state
+
+__author__ = "Dan Washusen"
+__license__ = "MIT"
+
+
+def test_create_client_config_sizes_pool_to_workers():
+    config = create_client_config(parse_args(["my-*", "--workers=32"]))
+
+    assert config.retries == {"total_max_attempts": 3, "mode": "adaptive"}
+    assert config.max_pool_connections == 32
+
+    config = create_client_config(parse_args(["my-*", "--workers=2", "--retry_mode=standard"]))
+
+    assert config.retries == {"total_max_attempts": 3, "mode": "standard"}
+    assert config.max_pool_connections == 10
+
+
+def test_create_client_config_allows_disabling_retries():
+    config = create_client_config(parse_args(["my-*", "--max_attempts=1"]))
+
+    assert config.retries == {"total_max_attempts": 1, "mode": "adaptive"}
+
+
+def test_parse_args_reads_arguments_from_file(tmp_path):
+    args_file = tmp_path / "simple-ami-cleaner.args"
+    args_file.write_text("--max_pool_connections=64\n--read_timeout=5\n--max_attempts=10\n")
+
+    config = create_client_config(parse_args(["my-*", f"@{args_file}"]))
+
+    assert config.retries == {"total_max_attempts": 10, "mode": "adaptive"}
+    assert config.max_pool_connections == 64
+    assert config.read_timeout == 5
+
+
+def test_ec2_client_factory_reuses_clients_across_threads(monkeypatch):
+    created_clients = []
+
+    def create_client(service_name, region_name=None, config=None):
+        client = object()
+        created_clients.append((service_name, region_name, config, client))
+        return client
+
+    monkeypatch.setattr(simple_ami_cleaner.skeleton.boto3, "client", create_client)
+    factory = Ec2ClientFactory(create_client_config(parse_args(["my-*"])))
+
+    clients = []
+    threads = [
+        threading.Thread(target=lambda: clients.append(factory.client("us-east-1")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(id(client) for client in clients)) == 1
+    assert factory.client("us-east-1") is clients[0]
+    assert factory.client("eu-west-1") is not clients[0]
+    assert [(service_name, region_name) for service_name, region_name, _, _ in created_clients] == [
+        ("ec2", "us-east-1"), ("ec2", "eu-west-1"),
+    ]
+
+
+def test_load_launch_template_state_round_trips(tmp_path):
+    state_path = str(tmp_path / "state.json")
+    launch_template_state = {
+        "LastFullScan": "2026-10-19T00:00:00+00:00",
+        "LaunchTemplates": {"lt-123": {"LatestVersionNumber": 2, "ImageIds": {"2": "abc124"}}},
+    }
+
+    save_launch_template_state(state_path, launch_template_state)
+
+    assert load_launch_template_state(state_path) == launch_template_state
+
+
+def test_load_launch_template_state_ignores_invalid_state(tmp_path):
+    state_path = tmp_path / "state.json"
+
+    state_path.write_text('{"LaunchTemplates": {"lt-123": ')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('["lt-123"]')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('{"LastFullScan": "yesterday"}')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('{"LastFullScan": "2026-10-18T00:00:00"}')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('{"LaunchTemplates": {"lt-123": {"ImageIds": {"1": "abc123"}}}}')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('{"LaunchTemplates": {"lt-123": [1, {"1": "abc123"}]}}')
+    assert load_launch_template_state(str(state_path)) == {}
+
+    state_path.write_text('{"LaunchTemplates": {"lt-123": {"LatestVersionNumber": "1", "ImageIds": {}}}}')
+    assert load_launch_template_state(str(state_path)) == {}
+
+
+def test_parse_args_rejects_sweep_snapshots_with_image_options():
+    assert parse_args(["--sweep_snapshots"]).sweep_snapshots is True
+
+    with pytest.raises(SystemExit):
+        parse_args(["--sweep_snapshots", "my-*"])
+    with pytest.raises(SystemExit):
+        parse_args(["--sweep_snapshots", "--print_used_image_ids_and_exit=/dev/stdout"])
+    with pytest.raises(SystemExit):
+        parse_args(["--sweep_snapshots", "--estimate_savings_and_exit=savings.csv"])
+
+
+def test_main_exits_when_report_cannot_be_opened(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(simple_ami_cleaner.skeleton.boto3, "client", lambda *args, **kwargs: pytest.fail())
+
+    with pytest.raises(SystemExit) as exit_info:
+        main(["--sweep_snapshots", f"--report={tmp_path / 'missing' / 'report.jsonl'}"])
+
+    assert exit_info.value.code == 1
+    assert "attempting to open report" in caplog.text